@@ -8,6 +8,9 @@ import zipfile
 import io
 import os
 
+# 快速平滑与基线去除内核（仅在启用时由R脚本source）
+FAST_KERNELS_PATH = Path(__file__).resolve().parent / 'fast_kernels.R'
+
 # 检查并安装R包
 @st.cache_resource
 def install_r_packages():
@@ -167,6 +170,186 @@ def run_r_script(script_content, work_dir):
     except Exception as e:
         return "", f"执行R脚本出错: {str(e)}", 1
 
+def to_r_value(value):
+    """将Python参数值转换为R字面量（None转为NA，布尔值转为TRUE/FALSE）"""
+    if value is None:
+        return 'NA'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    return value
+
+def build_fast_kernels_r_code(params):
+    """生成加载快速内核的R代码（未启用时不依赖 fast_kernels.R）"""
+    if params.get('fastKernels'):
+        return f"source('{FAST_KERNELS_PATH.as_posix()}')"
+    return ""
+
+def build_smoothing_r_code(spectra_var, params):
+    """生成Savitzky-Golay平滑R代码（可选快速内核）"""
+    if params.get('fastKernels'):
+        return f"""{spectra_var} <- fastSmoothSavitzkyGolay({spectra_var},
+    halfWindowSize = {params['halfWindowSize']})"""
+    return f"""{spectra_var} <- smoothIntensity({spectra_var}, method = "SavitzkyGolay",
+    halfWindowSize = {params['halfWindowSize']})"""
+
+def build_baseline_r_code(spectra_var, params):
+    """生成SNIP基线去除R代码（可选快速内核）"""
+    if params.get('fastKernels'):
+        return f"""{spectra_var} <- fastRemoveBaselineSNIP({spectra_var},
+    iterations = {params['iterations']})"""
+    return f"""{spectra_var} <- removeBaseline({spectra_var}, method = "SNIP",
+    iterations = {params['iterations']})"""
+
+def build_mz_range_r_code(params):
+    """生成m/z范围截取与重采样R代码（作用于导入后的单个光谱 s）"""
+    if params.get('mzMin') is None:
+        return ""
+    
+    code = f"""
+  # m/z范围截取（光谱未完全覆盖窗口时记录提示）
+  if (length(mass(s)) > 0 && all(is.finite(mass(s))) &&
+      (min(mass(s)) > {params['mzMin']} || max(mass(s)) < {params['mzMax']})) {{
+    notes <- c(notes, sprintf("数据范围(%.0f-%.0f)未覆盖m/z窗口", min(mass(s)), max(mass(s))))
+  }}
+  keep <- which(mass(s) >= {params['mzMin']} & mass(s) <= {params['mzMax']})
+  # 窗口内实际采集的数据点数（重采样前），用于质量控制的点数检查
+  n_points <- length(keep)
+  s <- createMassSpectrum(mass = mass(s)[keep], intensity = intensity(s)[keep],
+                          metaData = metaData(s))
+"""
+    if params.get('resampleStep') is not None:
+        code += f"""
+  # 重采样到固定m/z网格（数据范围以外补0，不外推）
+  if (length(mass(s)) > 1 && all(is.finite(mass(s))) && all(is.finite(intensity(s)))) {{
+    mz_grid <- seq({params['mzMin']}, {params['mzMax']}, by = {params['resampleStep']})
+    resampled_y <- approx(mass(s), intensity(s), xout = mz_grid, rule = 1, ties = mean)$y
+    resampled_y[is.na(resampled_y)] <- 0
+    s <- createMassSpectrum(mass = mz_grid, intensity = resampled_y, metaData = metaData(s))
+    resampled <- TRUE
+  }}
+"""
+    return code
+
+def build_qc_r_code(spectra_dir, params, result_var):
+    """生成光谱质量控制R代码：逐个导入TXT并在预处理前剔除不合格光谱"""
+    return f"""
+# 光谱质量控制（在昂贵的预处理之前剔除不合格光谱）
+cat("光谱质量控制...\\n")
+spectrum_files <- list.files('{Path(spectra_dir).as_posix()}', pattern = "\\\\.txt$",
+                             ignore.case = TRUE, full.names = TRUE)
+qc_rows <- list()
+{result_var} <- list()
+# 数据点数至少要覆盖平滑窗口，否则smoothIntensity会使整批处理失败
+min_points <- max({params['minPoints']}, 2 * {params['halfWindowSize']} + 1)
+
+for (f in spectrum_files) {{
+  imported <- tryCatch(importTxt(f, verbose = FALSE), error = function(e) NULL)
+
+  if (is.null(imported) || length(imported) == 0) {{
+    qc_rows[[length(qc_rows) + 1]] <- data.frame(
+      file = basename(f), n_points = 0, n_grid = 0, tic = NA, regular_mass = NA,
+      saturated_fraction = NA, status = "剔除", reason = "导入失败", note = "",
+      stringsAsFactors = FALSE)
+    next
+  }}
+
+  s <- imported[[1]]
+  notes <- character()
+  resampled <- FALSE
+  n_points <- length(intensity(s))
+{build_mz_range_r_code(params)}  y <- intensity(s)
+  n_grid <- length(y)
+  finite <- n_grid > 0 && all(is.finite(mass(s))) && all(is.finite(y))
+  tic <- if (finite) sum(y) else NA
+  # 浮点生成的重采样网格本身是规则的，isRegular会误判，直接视为规则
+  regular <- resampled ||
+    (finite && n_grid > 1 && !is.unsorted(mass(s)) && isRegular(s))
+  saturated <- if (finite) mean(y >= max(y)) else NA
+
+  reasons <- character()
+  if (n_points == 0) {{
+    reasons <- c(reasons, "空光谱")
+  }} else if (n_points < min_points) {{
+    reasons <- c(reasons, sprintf("数据点过少(%d)", n_points))
+  }}
+  if (n_grid > 0 && !finite) {{
+    reasons <- c(reasons, "含非法数值")
+  }}
+  if (!is.na(tic) && tic <= {params['minTIC']}) {{
+    reasons <- c(reasons, sprintf("TIC过低(%.1f)", tic))
+  }}
+  # 导出的m/z常被舍入，不规则仅作提示，不剔除
+  if (n_grid > 1 && finite && !regular) {{
+    notes <- c(notes, "质量轴不规则")
+  }}
+  if (!is.na(saturated) && saturated > {params['maxSaturation']}) {{
+    reasons <- c(reasons, sprintf("信号饱和(%.1f%%)", 100 * saturated))
+  }}
+
+  passed <- length(reasons) == 0
+  qc_rows[[length(qc_rows) + 1]] <- data.frame(
+    file = basename(f), n_points = n_points, n_grid = n_grid, tic = tic, regular_mass = regular,
+    saturated_fraction = saturated, status = if (passed) "通过" else "剔除",
+    reason = paste(reasons, collapse = "; "), note = paste(notes, collapse = "; "),
+    stringsAsFactors = FALSE)
+
+  if (passed) {{
+    {result_var}[[length({result_var}) + 1]] <- s
+  }}
+}}
+
+if (length(qc_rows) == 0) {{
+  stop("未找到TXT光谱文件")
+}}
+qc_report <- do.call(rbind, qc_rows)
+"""
+
+def build_qc_finish_r_code(qc_path, result_var):
+    """生成质量控制收尾R代码：保存报告，并在没有可用光谱时终止"""
+    return f"""
+write.csv(qc_report, '{Path(qc_path).as_posix()}', row.names = FALSE)
+cat(sprintf("质量控制: %d 个通过, %d 个剔除, %d 个缺失\\n", length({result_var}),
+            sum(qc_report$status == "剔除"), sum(qc_report$status == "缺失")))
+if (any(qc_report$status != "通过")) {{
+  rejected <- qc_report[qc_report$status != "通过", ]
+  for (k in seq_len(nrow(rejected))) {{
+    cat(sprintf("  %s %s: %s\\n", rejected$status[k], rejected$file[k], rejected$reason[k]))
+  }}
+}}
+noted <- qc_report[qc_report$status == "通过" & qc_report$note != "", ]
+for (k in seq_len(nrow(noted))) {{
+  cat(sprintf("  提示 %s: %s\\n", noted$file[k], noted$note[k]))
+}}
+if (length({result_var}) == 0) {{
+  reason_counts <- table(sub("\\\\(.*", "", unlist(strsplit(
+    qc_report$reason[qc_report$status == "剔除"], "; ", fixed = TRUE))))
+  stop(sprintf("没有光谱通过质量控制（%s），请检查数据或放宽质量控制阈值",
+               paste(sprintf("%s: %d", names(reason_counts), reason_counts), collapse = ", ")))
+}}
+"""
+
+def show_qc_report(qc_df, file_name):
+    """显示光谱质量控制报告"""
+    n_rejected = (qc_df['status'] == '剔除').sum()
+    n_missing = (qc_df['status'] == '缺失').sum()
+    if n_rejected > 0:
+        st.warning(f"⚠️ 质量控制: {n_rejected} 个光谱未通过，已从后续处理中剔除")
+    if n_missing > 0:
+        st.warning(f"⚠️ 质量控制: Excel中列出的 {n_missing} 个文件在ZIP中缺失")
+    n_noted = ((qc_df['status'] == '通过') & qc_df['note'].notna()).sum()
+    if n_noted > 0:
+        st.info(f"💡 质量控制: {n_noted} 个通过的光谱带有提示，详见报告")
+    
+    with st.expander("查看质量控制报告"):
+        st.dataframe(qc_df, use_container_width=True)
+        st.download_button(
+            "🧪 下载质量控制报告",
+            data=qc_df.to_csv(index=False),
+            file_name=file_name,
+            mime="text/csv",
+            use_container_width=True
+        )
+
 # 主界面
 st.markdown('<div class="main-header">🔬 MALDI-TOF MS 模版化处理平台</div>', unsafe_allow_html=True)
 st.markdown('<div class="sub-header">基于训练集建立特征模版，批量处理验证集</div>', unsafe_allow_html=True)
@@ -197,12 +380,35 @@ with st.sidebar:
         SNR = st.slider("信噪比阈值", 1.0, 10.0, 2.0, 0.5)
         tolerance = st.slider("对齐容差", 0.001, 0.02, 0.008, 0.001, format="%.4f")
         iterations = st.slider("基线去除迭代次数", 50, 200, 100, 10)
+        fastKernels = st.checkbox("使用快速平滑/基线内核（实验性）", value=False,
+                                  help="批量FFT平滑与向量化SNIP，需先用 benchmark_kernels.R 确认与MALDIquant一致")
+    
+    with st.expander("质量控制设置", expanded=False):
+        minPoints = st.number_input("最少数据点数", 0, 1000000, 1000, 100)
+        minTIC = st.number_input("最低总离子流(TIC)", 0.0, value=0.0, step=100.0)
+        maxSaturation = st.slider("最大饱和点比例", 0.0, 0.2, 0.01, 0.005, format="%.3f")
+    
+    with st.expander("m/z范围与重采样", expanded=False):
+        trimEnabled = st.checkbox("截取m/z范围", value=False)
+        mzMin = st.number_input("m/z下限", 0.0, value=2000.0, step=100.0, disabled=not trimEnabled)
+        mzMax = st.number_input("m/z上限", 0.0, value=20000.0, step=100.0, disabled=not trimEnabled)
+        resampleEnabled = st.checkbox("重采样到固定网格", value=False, disabled=not trimEnabled,
+                                      help="重采样后，半峰宽按网格点数计算")
+        resampleStep = st.number_input("网格步长 (Da)", 0.1, value=1.0, step=0.5,
+                                       disabled=not (trimEnabled and resampleEnabled))
     
     processing_params = {
         'halfWindowSize': halfWindowSize,
         'SNR': SNR,
         'tolerance': tolerance,
-        'iterations': iterations
+        'iterations': iterations,
+        'minPoints': minPoints,
+        'minTIC': minTIC,
+        'maxSaturation': maxSaturation,
+        'mzMin': mzMin if trimEnabled else None,
+        'mzMax': mzMax if trimEnabled else None,
+        'resampleStep': resampleStep if trimEnabled and resampleEnabled else None,
+        'fastKernels': fastKernels
     }
     
     st.divider()
@@ -237,6 +443,17 @@ with tab1:
                     st.error("❌ R环境未安装，无法处理数据！")
                     st.stop()
                 
+                if trimEnabled and mzMin >= mzMax:
+                    st.error("❌ m/z下限必须小于上限！")
+                    st.stop()
+                
+                if trimEnabled and resampleEnabled:
+                    n_grid = int((mzMax - mzMin) // resampleStep) + 1
+                    if n_grid < 2 * halfWindowSize + 1:
+                        st.error(f"❌ 重采样网格只有 {n_grid} 个点，少于平滑窗口 {2 * halfWindowSize + 1} 个点！"
+                                 "请扩大m/z范围、减小网格步长或减小半峰宽")
+                        st.stop()
+                
                 # 创建进度条和状态文本
                 progress_bar = st.progress(0)
                 status_text = st.empty()
@@ -267,6 +484,7 @@ with tab1:
                     progress_bar.progress(20)
                     
                     params = processing_params
+                    qc_path = Path(temp_dir) / 'qc_report.csv'
                     
                     r_script = f"""
 # 设置用户库路径
@@ -282,13 +500,30 @@ if (!dir.exists(user_lib)) {{
 library('MALDIquant')
 library('MALDIquantForeign')
 library('readxl')
+{build_fast_kernels_r_code(params)}
 
 cat("开始处理训练集...\\n")
 
 # 读取训练集
 cat("读取Excel和TXT文件...\\n")
 samples <- read_excel('{excel_path.as_posix()}')
-training_spectra <- importTxt('{train_dir.as_posix()}')
+{build_qc_r_code(train_dir, params, 'training_spectra')}
+# 核对Excel样本表与TXT文件
+listed_files <- as.character(na.omit(samples$file))
+missing_files <- setdiff(listed_files, basename(spectrum_files))
+if (length(missing_files) > 0) {{
+  qc_report <- rbind(qc_report, data.frame(
+    file = missing_files, n_points = 0, n_grid = 0, tic = NA, regular_mass = NA,
+    saturated_fraction = NA, status = "缺失", reason = "Excel中列出但ZIP中无TXT文件",
+    note = "", stringsAsFactors = FALSE))
+}}
+unlisted <- qc_report$status == "通过" & !(qc_report$file %in% listed_files)
+qc_report$status[unlisted] <- "剔除"
+qc_report$reason[unlisted] <- "Excel中无对应记录"
+training_spectra <- training_spectra[
+  sapply(training_spectra, function(s) basename(s@metaData$file)) %in% listed_files
+]
+{build_qc_finish_r_code(qc_path, 'training_spectra')}
 cat(sprintf("导入训练集: %d 个光谱\\n", length(training_spectra)))
 
 # 预处理
@@ -296,12 +531,10 @@ cat("执行预处理（1/5）: 强度转换...\\n")
 training_spectra <- transformIntensity(training_spectra, method = "sqrt")
 
 cat("执行预处理（2/5）: 平滑处理...\\n")
-training_spectra <- smoothIntensity(training_spectra, method = "SavitzkyGolay", 
-                                     halfWindowSize = {params['halfWindowSize']})
+{build_smoothing_r_code('training_spectra', params)}
 
 cat("执行预处理（3/5）: 基线去除...\\n")
-training_spectra <- removeBaseline(training_spectra, method = "SNIP", 
-                                   iterations = {params['iterations']})
+{build_baseline_r_code('training_spectra', params)}
 
 cat("执行预处理（4/5）: 强度校准...\\n")
 training_spectra <- calibrateIntensity(training_spectra, method = "TIC")
@@ -372,11 +605,20 @@ write.csv(train_df,
 # 保存处理参数
 cat("保存处理参数...\\n")
 params_df <- data.frame(
-  parameter = c('halfWindowSize', 'SNR', 'tolerance', 'iterations'),
+  parameter = c('halfWindowSize', 'SNR', 'tolerance', 'iterations',
+                'minPoints', 'minTIC', 'maxSaturation',
+                'mzMin', 'mzMax', 'resampleStep', 'fastKernels'),
   value = c({params['halfWindowSize']}, 
             {params['SNR']}, 
             {params['tolerance']},
-            {params['iterations']})
+            {params['iterations']},
+            {params['minPoints']},
+            {params['minTIC']},
+            {params['maxSaturation']},
+            {to_r_value(params['mzMin'])},
+            {to_r_value(params['mzMax'])},
+            {to_r_value(params['resampleStep'])},
+            {to_r_value(params['fastKernels'])})
 )
 write.csv(params_df, '{temp_dir}/processing_params.csv', row.names = FALSE)
 
@@ -401,6 +643,7 @@ cat(sprintf("  特征数: %d\\n", ncol(train_df) - 1))
                         template_df = pd.read_csv(Path(temp_dir) / 'feature_template.csv')
                         train_df = pd.read_csv(Path(temp_dir) / 'peak_intensity_train.csv')
                         params_df = pd.read_csv(Path(temp_dir) / 'processing_params.csv')
+                        qc_df = pd.read_csv(qc_path)
                         
                         progress_bar.progress(85)
                         
@@ -436,6 +679,8 @@ cat(sprintf("  特征数: %d\\n", ncol(train_df) - 1))
                         with col3:
                             st.metric("m/z范围", f"{template_df['mz'].min():.0f} - {template_df['mz'].max():.0f}")
                         
+                        show_qc_report(qc_df, "qc_report_train.csv")
+                        
                         # 显示参数
                         with st.expander("查看处理参数"):
                             st.dataframe(params_df, use_container_width=True)
@@ -539,6 +784,7 @@ with tab2:
                     st.session_state.template_data.to_csv(template_path, index=False)
                     
                     params = st.session_state.processing_params
+                    qc_path = Path(temp_dir) / 'qc_report.csv'
                     
                     progress_bar.progress(30)
                     
@@ -558,6 +804,7 @@ if (!dir.exists(user_lib)) {{
 
 library('MALDIquant')
 library('MALDIquantForeign')
+{build_fast_kernels_r_code(params)}
 
 cat("使用训练集模版处理验证集...\\n")
 
@@ -568,7 +815,8 @@ cat(sprintf("特征模版: %d 个m/z\\n", length(template_mz)))
 
 # 读取验证集
 cat("读取验证集TXT文件...\\n")
-validation_spectra <- importTxt('{valid_dir.as_posix()}')
+{build_qc_r_code(valid_dir, params, 'validation_spectra')}
+{build_qc_finish_r_code(qc_path, 'validation_spectra')}
 cat(sprintf("导入验证集: %d 个光谱\\n", length(validation_spectra)))
 
 # 预处理
@@ -576,12 +824,10 @@ cat("执行预处理（1/4）: 强度转换...\\n")
 validation_spectra <- transformIntensity(validation_spectra, method = "sqrt")
 
 cat("执行预处理（2/4）: 平滑处理...\\n")
-validation_spectra <- smoothIntensity(validation_spectra, method = "SavitzkyGolay",
-                                      halfWindowSize = {params['halfWindowSize']})
+{build_smoothing_r_code('validation_spectra', params)}
 
 cat("执行预处理（3/4）: 基线去除...\\n")
-validation_spectra <- removeBaseline(validation_spectra, method = "SNIP",
-                                     iterations = {params['iterations']})
+{build_baseline_r_code('validation_spectra', params)}
 
 cat("执行预处理（4/4）: 强度校准...\\n")
 validation_spectra <- calibrateIntensity(validation_spectra, method = "TIC")
@@ -651,6 +897,7 @@ cat(sprintf("  特征数: %d (与训练集一致)\\n", ncol(valid_df) - 1))
                         progress_bar.progress(85)
                         
                         valid_df = pd.read_csv(Path(temp_dir) / 'peak_intensity_validation.csv')
+                        qc_df = pd.read_csv(qc_path)
                         
                         progress_bar.progress(95)
                         
@@ -676,6 +923,8 @@ cat(sprintf("  特征数: %d (与训练集一致)\\n", ncol(valid_df) - 1))
                         with col3:
                             st.metric("特征一致性", "✅ 与训练集一致")
                         
+                        show_qc_report(qc_df, "qc_report_validation.csv")
+                        
                         # 显示日志
                         with st.expander("查看处理日志"):
                             st.code(stdout, language='text')